@@ -3,23 +3,205 @@
 from __future__ import annotations
 import os
 import sys
-from typing import NoReturn
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, NoReturn
 
+import orjson
+import requests
 from gql import Client
+from gql.client import SyncClientSession
+from gql.transport.exceptions import (
+    TransportProtocolError, TransportServerError,
+)
 from gql.transport.requests import RequestsHTTPTransport
+from graphql import ExecutionResult
+from graphql.language.ast import DocumentNode
+from graphql.language.printer import print_ast
+from requests.adapters import HTTPAdapter, Retry
 
 
-def make_client() -> Client | NoReturn:
+@lru_cache(maxsize=128)
+def serialize_query(document: DocumentNode) -> str:
+    '''Convert the given query document back to a string, once per document.
+
+    Our documents are module-level constants or cached themselves, so this
+    saves walking the whole syntax tree for every request.
+    '''
+    return print_ast(document)
+
+
+class GitHubRetry(Retry):
+    '''Also retry 403 responses, if they come with a Retry-After header.
+
+    That is how GitHub signals its secondary rate limits; other 403s (e.g.
+    for a bad token) are not worth retrying.
+    '''
+    RETRY_AFTER_STATUS_CODES = Retry.RETRY_AFTER_STATUS_CODES | {403}
+
+
+class GitHubTransport(RequestsHTTPTransport):
+    '''A RequestsHTTPTransport that uses orjson to (de)serialize JSON.
+
+    GitHub's responses can be hundreds of kilobytes, and orjson parses them
+    much faster than the standard library's json module. The session also
+    keeps a larger pool of connections alive for parallel queries.
+    '''
+
+    def connect(self: GitHubTransport) -> None:
+        super().connect()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                              max_retries=GitHubRetry(
+                                  total=self.retries,
+                                  backoff_factor=self.retry_backoff_factor,
+                                  status_forcelist=self.retry_status_forcelist,
+                                  allowed_methods=None,
+                              ))
+        for prefix in 'http://', 'https://':
+            self.session.mount(prefix, adapter)
+
+    def execute(self: GitHubTransport, document: DocumentNode,
+                variable_values: dict[str, Any] | None = None,
+                operation_name: str | None = None,
+                timeout: int | None = None,
+                extra_args: dict[str, Any] | None = None,
+                upload_files: bool = False) -> ExecutionResult:
+        if upload_files:
+            # We never upload files; let gql deal with the multipart encoding.
+            return super().execute(document, variable_values, operation_name,
+                                   timeout, extra_args, upload_files)
+        payload: dict[str, Any] = {'query': serialize_query(document)}
+        if variable_values:
+            payload['variables'] = variable_values
+        if operation_name:
+            payload['operationName'] = operation_name
+        post_args: dict[str, Any] = {
+            'data': orjson.dumps(payload),
+            'headers': {**(self.headers or {}),
+                        'Content-Type': 'application/json'},
+            'auth': self.auth,
+            'cookies': self.cookies,
+            'timeout': timeout or self.default_timeout,
+            'verify': self.verify,
+        }
+        post_args.update(self.kwargs)
+        post_args.update(extra_args or {})
+        try:
+            response = self.session.request(self.method, self.url,
+                                            **post_args)
+        except requests.exceptions.RetryError as exc:
+            # We ran out of retries, e.g. because we're being rate-limited.
+            raise TransportServerError(str(exc)) from exc
+        self.response_headers = response.headers
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as exc:
+            raise TransportServerError(str(exc), response.status_code) \
+                from exc
+        try:
+            result = orjson.loads(response.content)
+        except orjson.JSONDecodeError as exc:
+            raise TransportProtocolError(
+                f'Server did not return a JSON answer: {response.text}',
+            ) from exc
+        if 'data' not in result and 'errors' not in result:
+            raise TransportProtocolError(
+                f'No "data" or "errors" keys in answer: {response.text}')
+        return ExecutionResult(data=result.get('data'),
+                               errors=result.get('errors'),
+                               extensions=result.get('extensions'))
+
+
+class CachedClient:
+    '''Wrap a Client, remembering query results for a limited time.
+
+    Results are keyed on the query document's identity and the variables
+    passed to it, so documents should be module-level constants (or otherwise
+    long-lived) to get any cache hits. At most max_entries results are kept;
+    the least recently used ones are evicted first.
+
+    By default, results are not cached at all: the server refetches statuses
+    every UPDATE_INTERVAL seconds, so a cache with a TTL shorter than that
+    would never be hit. Pass a ttl to execute() for queries whose results
+    are worth keeping for longer, like the check definitions.
+
+    Queries go through a single session that is opened on first use and kept
+    until close() is called, so that its HTTP connection is reused instead
+    of paying for a new TCP and TLS handshake on every query.
+
+    Instances may be shared between threads.
+    '''
+
+    def __init__(self: CachedClient, client: Client, ttl: float = 0,
+                 max_entries: int = 128) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: OrderedDict[tuple, tuple[float, dict[str, Any]]] = \
+            OrderedDict()
+        self._session: SyncClientSession | None = None
+        self._lock = threading.Lock()
+
+    def connect(self: CachedClient) -> SyncClientSession:
+        '''Open the persistent session, if it isn't open already.'''
+        with self._lock:
+            if self._session is None:
+                self._session = self.client.connect_sync()
+            return self._session
+
+    def close(self: CachedClient) -> None:
+        '''Close the persistent session and its HTTP connections.'''
+        with self._lock:
+            if self._session is not None:
+                self.client.close_sync()
+                self._session = None
+
+    def execute(self: CachedClient, document: DocumentNode,
+                variable_values: dict[str, Any] | None = None,
+                ttl: float | None = None) -> dict[str, Any]:
+        '''Run the given query, unless its result is at most ttl seconds old.
+
+        If ttl is not given, the client's default TTL applies. If the TTL is
+        zero, the result is neither looked up in nor stored in the cache.
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            return self.connect().execute(document, variable_values)
+        key = id(document), tuple(sorted((variable_values or {}).items()))
+        now = time.monotonic()
+        with self._lock:
+            if (cached := self._cache.get(key)) is not None:
+                timestamp, result = cached
+                if now - timestamp < ttl:
+                    self._cache.move_to_end(key)
+                    return result
+        result = self.connect().execute(document, variable_values)
+        with self._lock:
+            self._cache[key] = now, result
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return result
+
+
+def make_client() -> CachedClient | NoReturn:
     try:
         github_token = os.environ['GITHUB_TOKEN']
     except KeyError:
         print('Please define the GITHUB_TOKEN environment variable!',
               file=sys.stderr)
         sys.exit(1)
-    return Client(
-        transport=RequestsHTTPTransport(
+    return CachedClient(Client(
+        transport=GitHubTransport(
             url='https://api.github.com/graphql',
             headers={'Authorization': f'bearer {github_token}'},
+            # Retry when rate-limited or on server errors, waiting as long as
+            # GitHub's Retry-After header asks us to.
+            retries=3,
         ),
-        # fetch_schema_from_transport=True,  # is this slow?
-    )
+        # Don't set fetch_schema_from_transport: GitHub's schema is several
+        # megabytes, and we don't validate queries locally anyway.
+    ))
@@ -1,39 +1,40 @@
 """Fetch and parse information about declared checks."""
 
-from collections.abc import Iterable
-from dataclass import dataclass
-import shlex
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+import re
 
 from gql import gql
 from graphql.language.ast import DocumentNode
 
-from ci_overview.api_client import Client
+from ci_overview.api_client import CachedClient
 
 DEFAULTENV: str = 'DEFAULTS.env'
 TIMEFORMAT: str = '%Y-%m-%dT%H:%M:%SZ'
-CHECK_DEFS_GRAPHQL: DocumentNode = gql('''\
-query files($repoOwner: String!, $repoName: String!, $object: String!) {
+# Check definitions change rarely, so don't refetch them every time.
+CHECK_DEFS_TTL: float = 60 * 60
+CHECK_TREE_GRAPHQL: DocumentNode = gql('''\
+query tree($repoOwner: String!, $repoName: String!, $object: String!) {
   repository(name: $repoName, owner: $repoOwner) {
     object(expression: $object) {
       # Directories are at most 3 levels deep. We can't put the `...
       # on Tree` stuff in a fragment as that would recurse forever.
-      # We need fileContents at each level to get all DEFAULTS.envs.
+      # Only list paths here; file contents are fetched separately.
       ... on Tree {
         entries {
           path
+          type
           object {
-            ...fileContents
             ... on Tree {
               entries {
                 path
+                type
                 object {
-                  ...fileContents
                   ... on Tree {
                     entries {
                       path
-                      object {
-                        ...fileContents
-                      }
+                      type
                     }
                   }
                 }
@@ -45,12 +46,25 @@ query files($repoOwner: String!, $repoName: String!, $object: String!) {
     }
   }
 }
-
+''')
+# A shell-style VAR=value word. The value may mix unquoted, single-quoted
+# and double-quoted parts, like shlex would parse it.
+_ENV_ASSIGNMENT: re.Pattern = re.compile(r'''
+    (?<!\S) ([A-Za-z_][A-Za-z0-9_]*) =
+    ( (?: "(?:[^"\\]|\\.)*" | '[^']*' | \\. | [^\s"'\\] )* )
+''', re.VERBOSE | re.DOTALL)
+_VALUE_PART: re.Pattern = re.compile(r'''
+    "((?:[^"\\]|\\.)*)" | '([^']*)' | \\(.) | ([^"'\\]+)
+''', re.VERBOSE | re.DOTALL)
+# Inside double quotes, shlex only treats backslashes as escapes before
+# another backslash or a double quote.
+_DQUOTE_ESCAPE: re.Pattern = re.compile(r'\\(["\\])')
+FILE_CONTENTS_FRAGMENT: str = '''\
 fragment fileContents on Blob {
   text
   isTruncated
 }
-''')
+'''
 
 
 @dataclass
@@ -60,33 +74,70 @@ class Check:
     name: str
     repository: str
     branch: str
+    ci_name: str
+
+
+def _unquote(value: str) -> str:
+    '''Remove shell quoting from the value part of a VAR=value word.'''
+    if not any(c in value for c in '"\'\\'):
+        return value
+    parts = []
+    for dquoted, squoted, escaped, plain in _VALUE_PART.findall(value):
+        parts.append(_DQUOTE_ESCAPE.sub(r'\1', dquoted) + squoted
+                     + escaped + plain)
+    return ''.join(parts)
 
 
 def parse_env_file(contents: str) -> dict[str, str]:
-    result = {}
-    for token in shlex.split(contents, comments=False):
-        var, is_assignment, value = token.partition('=')
-        if is_assignment:
-            result[var] = value
-    return result
+    return {var: _unquote(value)
+            for var, value in _ENV_ASSIGNMENT.findall(contents)}
+
+
+def process_gql_directory(directory: dict[str, dict]) -> list[str]:
+    '''Return the paths of all .env files in the given tree listing.'''
+    paths = []
+    stack = [directory]
+    while stack:
+        for entry in stack.pop()['object']['entries']:
+            if entry['type'] == 'blob':
+                if entry['path'].endswith('.env'):
+                    paths.append(entry['path'])
+            elif entry['type'] == 'tree' and entry.get('object'):
+                stack.append(entry)   # This is a directory. Look inside.
+    return paths
+
+
+@lru_cache
+def env_files_query(num_files: int) -> DocumentNode:
+    '''Build a query fetching the contents of num_files files at once.
+
+    Each file is aliased as fileN and its "branch:path" expression is taken
+    from the $fileN variable, so the document can be reused.
+    '''
+    params = ''.join(f', $file{i}: String!' for i in range(num_files))
+    aliases = ''.join(f'    file{i}: object(expression: $file{i}) '
+                      '{ ...fileContents }\n' for i in range(num_files))
+    return gql('query files($repoOwner: String!, $repoName: String!'
+               f'{params}) {{\n'
+               '  repository(name: $repoName, owner: $repoOwner) {\n'
+               f'{aliases}  }}\n}}\n\n' + FILE_CONTENTS_FRAGMENT)
 
 
-def process_gql_directory(directory: dict[str, dict], common_path: str) \
-        -> Iterable[tuple[tuple[str], str]]:
+def process_gql_files(repository: dict[str, dict], paths: list[str],
+                      common_path: str) \
+        -> list[tuple[tuple[str, ...], dict[str, str]]]:
+    '''Parse the files fetched by env_files_query for the given paths.'''
     common_path = common_path.strip('/') + '/'
-    for entry in directory['object']['entries']:
-        if 'text' in entry['object']:
-            # This is a file. Get its contents.
-            assert not entry['object']['isTruncated'], \
-                f'got truncated object {entry["path"]}'
-            yield (tuple(entry['path'].removeprefix(common_path).split('/')),
-                   parse_env_file(entry['object']['text']))
-        else:
-            # This is a directory. Recurse.
-            yield from process_gql_directory(entry)
-
-
-def get_all_checks(client: Client,
+    env_files = []
+    for i, path in enumerate(paths):
+        blob = repository[f'file{i}']
+        assert not blob['isTruncated'], f'got truncated object {path}'
+        env_files.append((tuple(path.removeprefix(common_path).split('/')),
+                          parse_env_file(blob['text'])))
+    return env_files
+
+
+def get_all_checks(client: CachedClient,
                    defs_repo: str = 'alisw/ali-bot',
                    defs_branch: str = 'master',
                    defs_dir: str = 'ci/repo-config') -> list[dict[str, str]]:
@@ -97,27 +148,60 @@ def get_all_checks(client: Client,
     owner, have_sep, repo = defs_repo.partition('/')
     if not have_sep:
         raise ValueError(f'repo not in ORG/REPO syntax: {defs_repo!r}')
-    env_files = list(process_gql_directory(client.execute(CHECK_DEFS_GRAPHQL, {
+    # First list the directory tree, then fetch all .env files in one go.
+    paths = process_gql_directory(client.execute(CHECK_TREE_GRAPHQL, {
         'repoOwner': owner, 'repoName': repo,
         'object': f'{defs_branch}:{defs_dir.strip("/")}',
-    })['data']['repository']))
+    }, ttl=CHECK_DEFS_TTL)['repository'])
+    if not paths:
+        # A query for no files at all would be a syntax error.
+        return []
+    query_vars = {'repoOwner': owner, 'repoName': repo}
+    for i, path in enumerate(paths):
+        query_vars[f'file{i}'] = f'{defs_branch}:{path}'
+    files = client.execute(env_files_query(len(paths)), query_vars,
+                           ttl=CHECK_DEFS_TTL)
+    env_files = process_gql_files(files['repository'], paths, defs_dir)
     defaults = {path[:-1]: variables for path, variables in env_files
-                if path[-1] == 'DEFAULTS.env'}
+                if path[-1] == DEFAULTENV}
+    # Merge the defaults applying to each directory only once, instead of
+    # once for every file in it.
+    merged_defaults: dict[tuple[str, ...], dict[str, str]] = \
+        {(): defaults.get((), {})}
     checks = []
     for path, variables in env_files:
-        if path[-1] == 'DEFAULTS.env':
+        if path[-1] == DEFAULTENV:
             continue
         role, container, filename = path
-        # Give this a name that couldn't be an env var name.
-        check = {}
-        check.update(defaults.get((), {}))
-        check.update(defaults.get((role,), {}))
-        check.update(defaults.get((role, container), {}))
-        check.update(variables)
+        if (role, container) not in merged_defaults:
+            if (role,) not in merged_defaults:
+                merged_defaults[role,] = {**merged_defaults[()],
+                                          **defaults.get((role,), {})}
+            merged_defaults[role, container] = {
+                **merged_defaults[role,],
+                **defaults.get((role, container), {}),
+            }
+        check = {**merged_defaults[role, container], **variables}
         checks.append(Check(
             short_name=filename.removesuffix('.env'),  # TODO: needed?
             name=check['CHECK_NAME'],
             repository=check['PR_REPO'],
             branch=check['PR_BRANCH'],
+            ci_name=check['CI_NAME'],
         ))
     return checks
+
+
+def checks_by_repo(checks: list[Check]) \
+        -> tuple[defaultdict[tuple[str, str], list[str]], dict[str, str]]:
+    '''Group check names by repo and branch, and make a name dict.
+
+    The name dict translates user-visible check names to internal names used
+    in the result URL.
+    '''
+    all_checks: defaultdict[tuple[str, str], list[str]] = defaultdict(list)
+    names_table: dict[str, str] = {}
+    for check in checks:
+        all_checks[check.repository, check.branch].append(check.name)
+        names_table[check.name] = check.ci_name
+    return all_checks, names_table
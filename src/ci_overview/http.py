@@ -1,178 +1,357 @@
 """Create an HTTP server to serve web requests."""
 
 from __future__ import annotations
+from datetime import datetime, timedelta
+import gzip
+import hashlib
+from html import escape
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from textwrap import dedent
+from operator import attrgetter
+import socket
+import sys
 import threading
+import traceback
 
-from ci_overview.api_client import Client, make_client
+import orjson
+
+from ci_overview.api_client import CachedClient, make_client
+from ci_overview.checks import TIMEFORMAT, checks_by_repo, get_all_checks
+from ci_overview.pull_requests import (
+    VALID_STATUSES, CheckStatus, get_all_check_statuses, get_status_url,
+    status_url,
+)
 from ci_overview._version import version
 
 
 exit_event: threading.Event = threading.Event()
+# Regenerate output this often, and forget memoized URLs every so many cycles.
+UPDATE_INTERVAL: float = 60
+URL_CACHE_CYCLES: int = 60
+# Mark statuses newer than this as recent.
+RECENT_HOURS: float = 24
 html_page: bytes = \
     b'<!doctype html><body><h2>Generating, please wait...</h2></body>'
+html_page_gz: bytes = gzip.compress(html_page)
 metrics_page: bytes = b'# Generating, please wait...\n'
+metrics_page_gz: bytes = gzip.compress(metrics_page)
+# The digest of the data the last HTML page was generated from, and the part
+# of the page after its intro (see HtmlOutput.begin).
+_last_html: tuple[bytes, bytes] = b'', b''
+_HTML_HEAD: bytes = '''\
+<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>ALICE CI overview</title>
+<style type="text/css">
+body { font-family: sans-serif; margin: 0; padding: 1rem; }
+#key { padding: 0.5rem; }
+#key[open] { border: 0.15rem dashed #777; }
+#key summary { font-weight: bold; }
+.branch-name { font-family: monospace; font-size: 1.25rem;
+               font-style: italic; margin-left: 0.75rem; }
+.branch-name::before { content: "("; }
+.branch-name::after { content: ")"; }
+.check-name { margin-left: 1rem; }
+.empty { font-size: 0.875rem; color: #777; font-style: italic; }
+.table { margin-left: 1.75rem; display: flex; place-content: start;
+         flex-flow: row wrap; }
+.status { padding: 0.25rem; margin: 0.25rem; --status-color: currentColor;
+          border: 0.1rem solid transparent; color: var(--status-color); }
+.status a { display: block; color: inherit; }
+.status.recent { border-color: var(--status-color); }
+.status.EXPECTED { --status-color: #24292f; border-style: dotted; }
+.status.PENDING { --status-color: #bf8700; }
+.status.SUCCESS { --status-color: #1a7f37; }
+.status.ERROR { --status-color: #cf222e; }
+.status.FAILURE { --status-color: #cf222e; font-weight: bold; }
+</style>
+</head>
+<body>
+<h1>ALICE CI overview</h1>
+'''.encode('utf-8')
+_HTML_INTRO_TEMPLATE: str = '''\
+<p>Document generated at {now}. Statuses from the
+   last <strong>{recent_hours:g} hours</strong>, i.e. newer than
+   {recent_cutoff}, are marked as
+   <span class="status recent">recent</span>.</p>
+'''
+_HTML_KEY: bytes = '''\
+<details id="key"><summary>Explanation (click to expand)</summary>
+<p>The results of the check listed in each heading are shown for each
+   pull request in a list.</p>
+<p>Results are ordered most recent first.</p>
+<p>Checks that completed after a set cutoff point (see the top of this
+   document for the specific time) have a border around them,
+   <span class="status recent">like this</span>.</p>
+<p>The colour coding works as follows:</p>
+<ul>
+  <li><span class="status EXPECTED">#0000</span> is an "expected"
+      status, which means that the CI has not picked up this PR at all
+      yet for the respective check.</li>
+  <li><span class="status PENDING">#0000</span> is a "pending" status,
+      which means that the CI has picked this PR up, but the check has
+      not yet completed.</li>
+  <li><span class="status SUCCESS">#0000</span> is a successful status,
+      i.e. this check has run and no errors were found.</li>
+  <!--<li><span class="status FAILURE">#0000</span> is a failed status,
+      which doesn't happen with the current CI system.</li>-->
+  <li><span class="status ERROR">#0000</span> is an error status, which
+      means that the check has run but a build error occurred.</li>
+</ul>
+</details>
+'''.encode('utf-8')
+# Opening tags for status cells, for each state and whether it's recent.
+_STATUS_OPEN: dict[tuple[str, bool], bytes] = {
+    (state, recent):
+    f'<div class="status {state} {"recent" if recent else "old"}"'
+    .encode('utf-8')
+    for state in VALID_STATUSES for recent in (True, False)
+}
 
 
 class Output: pass
 class HtmlOutput(Output):
-    '''Export the overview table as a HTML document.'''
+    '''Export the overview table as a HTML document.
+
+    The document is built up in memory; call getvalue() to get its contents.
+    '''
+
+    def __init__(self: HtmlOutput, recent_hours: float) -> None:
+        self.now = datetime.utcnow()
+        self.recent_hours = recent_hours
+        self.recent_cutoff = (self.now - timedelta(hours=recent_hours)) \
+            .strftime(TIMEFORMAT)
+        self.buf = bytearray()
 
     def begin(self: HtmlOutput) -> None:
         '''Output the HTML <head> element and initial boilerplate.'''
-        print(dedent('''\
-        <!doctype html>
-        <html>
-        <head>
-        <meta charset="utf-8">
-        <title>ALICE CI overview</title>
-        <style type="text/css">
-        body { font-family: sans-serif; margin: 0; padding: 1rem; }
-        #key { padding: 0.5rem; }
-        #key[open] { border: 0.15rem dashed #777; }
-        #key summary { font-weight: bold; }
-        .branch-name { font-family: monospace; font-size: 1.25rem;
-                       font-style: italic; margin-left: 0.75rem; }
-        .branch-name::before { content: "("; }
-        .branch-name::after { content: ")"; }
-        .check-name { margin-left: 1rem; }
-        .empty { font-size: 0.875rem; color: #777; font-style: italic; }
-        .table { margin-left: 1.75rem; display: flex; place-content: start;
-                 flex-flow: row wrap; }
-        .status { padding: 0.25rem; margin: 0.25rem; --status-color: currentColor;
-                  border: 0.1rem solid transparent; color: var(--status-color); }
-        .status a { display: block; color: inherit; }
-        .status.recent { border-color: var(--status-color); }
-        .status.EXPECTED { --status-color: #24292f; border-style: dotted; }
-        .status.PENDING { --status-color: #bf8700; }
-        .status.SUCCESS { --status-color: #1a7f37; }
-        .status.ERROR { --status-color: #cf222e; }
-        .status.FAILURE { --status-color: #cf222e; font-weight: bold; }
-        </style>
-        </head>
-        <body>
-        <h1>ALICE CI overview</h1>
-        '''), dedent(f'''\
-        <p>Document generated at {NOW.strftime(TIMEFORMAT)}. Statuses from the
-           last <strong>{self.recent_hours:g} hours</strong>, i.e. newer than
-           {self.recent_cutoff}, are marked as
-           <span class="status recent">recent</span>.</p>
-        '''), dedent('''\
-        <details id="key"><summary>Explanation (click to expand)</summary>
-        <p>The results of the check listed in each heading are shown for each
-           pull request in a list.</p>
-        <p>Results are ordered most recent first.</p>
-        <p>Checks that completed after a set cutoff point (see the top of this
-           document for the specific time) have a border around them,
-           <span class="status recent">like this</span>.</p>
-        <p>The colour coding works as follows:</p>
-        <ul>
-          <li><span class="status EXPECTED">#0000</span> is an "expected"
-              status, which means that the CI has not picked up this PR at all
-              yet for the respective check.</li>
-          <li><span class="status PENDING">#0000</span> is a "pending" status,
-              which means that the CI has picked this PR up, but the check has
-              not yet completed.</li>
-          <li><span class="status SUCCESS">#0000</span> is a successful status,
-              i.e. this check has run and no errors were found.</li>
-          <!--<li><span class="status FAILURE">#0000</span> is a failed status,
-              which doesn't happen with the current CI system.</li>-->
-          <li><span class="status ERROR">#0000</span> is an error status, which
-              means that the check has run but a build error occurred.</li>
-        </ul>
-        </details>
-        '''), sep='', end='', file=self.output_file)
+        self.buf += _HTML_HEAD
+        self.buf += _HTML_INTRO_TEMPLATE.format(
+            now=self.now.strftime(TIMEFORMAT), recent_hours=self.recent_hours,
+            recent_cutoff=self.recent_cutoff,
+        ).encode('utf-8')
+        self.buf += _HTML_KEY
 
     def repo_header(self: HtmlOutput, repo: str, branch: str) -> None:
         '''Output a heading with the repository and branch name.'''
-        print(f'<h2>{repo} <span class="branch-name">{branch}</span></h2>',
-              file=self.output_file)
+        self.buf += b'<h2>'
+        self.buf += escape(repo).encode('utf-8')
+        self.buf += b' <span class="branch-name">'
+        self.buf += escape(branch).encode('utf-8')
+        self.buf += b'</span></h2>\n'
 
     def check_header(self: HtmlOutput, check_name: str) -> None:
         '''Output the given check name.'''
-        print(f'<h3 class="check-name">{check_name}</h3>',
-              file=self.output_file)
+        self.buf += b'<h3 class="check-name">'
+        self.buf += escape(check_name).encode('utf-8')
+        self.buf += b'</h3>\n'
 
     def empty_table(self: HtmlOutput) -> None:
         '''Output a helpful message for a table with no PRs.'''
-        print('<div class="table empty">(no open non-draft PRs here)</div>',
-              file=self.output_file)
+        self.buf += \
+            b'<div class="table empty">(no open non-draft PRs here)</div>\n'
 
-    def overview_table(self: HtmlOutput, pr_statuses: list[Check]) -> None:
+    def overview_table_prep(self: HtmlOutput,
+                            pr_statuses: list[CheckStatus]) -> tuple[int, str]:
+        '''Sort statuses most recent first and make a PR number template.'''
+        pr_statuses.sort(key=attrgetter('createdAt'), reverse=True)
+        prnum_len = len(str(max(status.pr for status in pr_statuses)))
+        return prnum_len, f'#{{:{prnum_len}d}}'
+
+    def overview_table(self: HtmlOutput, pr_statuses: list[CheckStatus]) -> None:
         '''Show a nicely formatted table of PR results for the given check.'''
         _, template = self.overview_table_prep(pr_statuses)
-        print('<div class="table">',
-              *(self.format_status(status, template.format(status['pr']))
-                for status in pr_statuses),
-              '</div>', sep='\n', file=self.output_file)
+        format_status, recent_cutoff = self.format_status, self.recent_cutoff
+        buf = self.buf
+        buf += b'<div class="table">\n'
+        for status in pr_statuses:
+            buf += format_status(status, template.format(status.pr),
+                                 recent_cutoff)
+        buf += b'</div>\n'
 
-    def format_status(self: HtmlOutput, status: Check, text: str) -> str:
+    def format_status(self: HtmlOutput, status: CheckStatus, text: str,
+                      recent_cutoff: str) -> bytes:
         '''Tag the given text as appropriate for the given status.
 
         If possible, the text is also hyperlinked to the document reporting
         check results.
         '''
         if (url := get_status_url(status)):
-            text = f'<a href="{url}">{text}</a>'
-        date = 'recent' if status['createdAt'] > self.recent_cutoff else 'old'
-        return (f'<div class="status {status["state"]} {date}"'
-                f' title="{status.get("createdAt", "")}">{text}</div>')
+            text = f'<a href="{escape(url)}">{text}</a>'
+        created = status.createdAt
+        return b''.join((
+            _STATUS_OPEN[status.state, created > recent_cutoff],
+            f' title="{escape(created)}">{text}</div>\n'.encode('utf-8'),
+        ))
 
     def end(self: HtmlOutput) -> None:
         '''Close any open tags.'''
-        print('</body></html>', file=self.output_file)
+        self.buf += b'</body></html>\n'
+
+    def getvalue(self: HtmlOutput) -> bytes:
+        '''Return the document generated so far.'''
+        return bytes(self.buf)
 
 
-def generate_html(client: Client) -> bytes:
-    return html_page
+def generate_html(client: CachedClient) -> bytes:
+    '''Fetch all checks and their statuses, and render them as HTML.'''
+    checks_list = get_all_checks(client)
+    all_checks, names_table = checks_by_repo(checks_list)
+    output = HtmlOutput(RECENT_HOURS)
+    all_statuses = get_all_check_statuses(client, all_checks, names_table,
+                                          output.now.strftime(TIMEFORMAT))
+    # If neither the data nor the set of recent statuses has changed since
+    # the last run, the tables would be the same; reuse them. Statuses only
+    # ever stop being recent, so counting the recent ones is enough. The
+    # intro (with the generation time) is cheap, so it's always redone.
+    global _last_html
+    num_recent = sum(status.createdAt > output.recent_cutoff
+                     for statuses in all_statuses.values()
+                     for check_statuses in statuses.values()
+                     for status in check_statuses)
+    key = hashlib.blake2b(orjson.dumps(
+        (checks_list, sorted(all_statuses.items()), num_recent),
+    ), digest_size=16).digest()
+    output.begin()
+    if key == _last_html[0]:
+        output.buf += _last_html[1]
+        return output.getvalue()
+    body_start = len(output.buf)
+    for (repo, branch), checks in sorted(all_checks.items()):
+        output.repo_header(repo, branch)
+        statuses = all_statuses[repo, branch]
+        for check in sorted(checks):
+            output.check_header(check)
+            if statuses[check]:
+                output.overview_table(statuses[check])
+            else:
+                output.empty_table()
+    output.end()
+    _last_html = key, bytes(output.buf[body_start:])
+    return output.getvalue()
 
 
-def generate_metrics(client: Client) -> bytes:
+def generate_metrics(client: CachedClient) -> bytes:
     return metrics_page
 
 
+def compress_page(page: bytes) -> tuple[bytes, bytes]:
+    '''Return the given page and its gzip-compressed version.'''
+    return page, gzip.compress(page, compresslevel=6)
+
+
 def regenerate_output() -> None:
-    global html_page, metrics_page
+    global html_page, html_page_gz, metrics_page, metrics_page_gz
     try:
         client = make_client()
     except SystemExit:  # TODO better exception
         exit_event.set()
         return
-    metrics_page = generate_metrics(client)
-    html_page = generate_html(client)
-    while not exit_event.wait(60):
-        metrics_page = generate_metrics(client)
-        html_page = generate_html(client)
+    try:
+        # Open the client's session up front and keep it (and its pool of
+        # HTTP connections) for the whole lifetime of the server.
+        client.connect()
+        cycle = 0
+        while True:
+            try:
+                # The metrics page is returned unchanged if its data hasn't
+                # changed, in which case there's no need to compress it again.
+                if (page := generate_metrics(client)) is not metrics_page:
+                    metrics_page, metrics_page_gz = compress_page(page)
+                html_page, html_page_gz = compress_page(generate_html(client))
+            except Exception:
+                # Network and API errors (e.g. TransportQueryError or
+                # TransportServerError) are usually temporary. Keep serving
+                # the last good pages and try again next time.
+                print('Failed to update pages, retrying in '
+                      f'{UPDATE_INTERVAL:g}s:', file=sys.stderr)
+                traceback.print_exc()
+            if exit_event.wait(UPDATE_INTERVAL):
+                break
+            cycle += 1
+            if cycle % URL_CACHE_CYCLES == 0:
+                status_url.cache_clear()
+    finally:
+        client.close()
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    '''Return whether the given Accept-Encoding header value allows gzip.
+
+    An explicit gzip entry takes precedence over a "*" entry, and either is
+    refused if its q-value is zero.
+    '''
+    qvalues: dict[str, float] = {}
+    for entry in accept_encoding.split(','):
+        coding, *params = entry.split(';')
+        qvalue = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding.strip().lower()] = qvalue
+    for coding in 'gzip', 'x-gzip', '*':
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return False
 
 
 class CIOverviewServer(BaseHTTPRequestHandler):
     """Serve both a human-readable HTML page and Prometheus metrics."""
     server_version = f'alice-ci-overview/{version}'
 
-    def do_HEAD(self: CIOverviewServer) -> None:
+    def setup(self: CIOverviewServer) -> None:
+        super().setup()
+        # Headers and body are sent separately; don't let Nagle's algorithm
+        # hold back the body until the client ACKs the headers.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def select_page(self: CIOverviewServer) \
+            -> tuple[str, bytes, bool] | None:
+        '''Return the content type, body and whether the body is gzipped.
+
+        Returns None if there is nothing at the requested path.
+        '''
         if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.send_header('Content-Length', str(len(html_page)))
-            self.end_headers()
+            content_type, page, page_gz = \
+                'text/html; charset=utf-8', html_page, html_page_gz
         elif self.path == '/metrics':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain; charset=utf-8')
-            self.send_header('Content-Length', str(len(metrics_page)))
-            self.end_headers()
+            content_type, page, page_gz = \
+                'text/plain; charset=utf-8', metrics_page, metrics_page_gz
         else:
+            return None
+        if accepts_gzip(self.headers.get('Accept-Encoding', '')):
+            return content_type, page_gz, True
+        return content_type, page, False
+
+    def send_page_headers(self: CIOverviewServer) -> bytes | None:
+        '''Send headers for the requested page and return its body.'''
+        if (selected := self.select_page()) is None:
             self.send_error(404, f'Nothing found at {self.path}!')
+            return None
+        content_type, body, is_gzipped = selected
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if is_gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        return body
+
+    def do_HEAD(self: CIOverviewServer) -> None:
+        self.send_page_headers()
 
     def do_GET(self: CIOverviewServer) -> None:
         """Handle GET requests to any path."""
-        self.do_HEAD()
-        if self.path == '/':
-            self.wfile.write(html_page)
-        elif self.path == '/metrics':
-            self.wfile.write(metrics_page)
-        else:
-            pass  # error already sent
+        if (body := self.send_page_headers()) is not None:
+            # wfile is unbuffered, so this hands the page to a single
+            # sendall() without copying it.
+            self.wfile.write(body)
 
 
 def main() -> None:
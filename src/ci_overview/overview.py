@@ -4,104 +4,55 @@ The overview links to check results in supporting terminals.
 '''
 
 import argparse
-import glob
-import itertools as it
-import math
 import os
 import os.path
 import shutil
 from collections import defaultdict
 from collections.abc import Iterable, Mapping   # for type checking
 from datetime import datetime, timedelta
+from functools import lru_cache
 from textwrap import dedent
-from typing import Optional, Union, Literal, Final, TypedDict
+from typing import Optional, Union, Literal, Final
 
-from gql import Client, gql
-from gql.transport.aiohttp import AIOHTTPTransport
-from graphql.language.ast import DocumentNode
 from alibot_helpers.utilities import parse_env_file
 
+from ci_overview.api_client import make_client
+from ci_overview.pull_requests import CheckStatus, get_all_check_statuses
+
 
 DEFAULTENV: Final[str] = 'DEFAULTS.env'
 TIMEFORMAT: Final[str] = '%Y-%m-%dT%H:%M:%SZ'
 NOW: Final[datetime] = datetime.utcnow()
 INDENT: Final[str] = '  '
 SEPARATOR: Final[str] = '  '
-GET_PR_STATUSES_GRAPHQL: Final[DocumentNode] = gql('''\
-query statuses($repoOwner: String!, $repoName: String!, $baseBranch: String!) {
-  repository(owner: $repoOwner, name: $repoName) {
-    pullRequests(last: 50, baseRefName: $baseBranch, states: OPEN) {
-      nodes {
-        number
-        title
-        isDraft
-        commits(last: 1) {
-          nodes {
-            commit {
-              oid
-              status {
-                contexts {
-                  context
-                  state
-                  createdAt
-                }
-              }
-            }
-          }
-        }
-      }
-    }
-  }
-}
-''')
-
-
 State = Union[Literal['EXPECTED'], Literal['ERROR'], Literal['FAILURE'],
               Literal['PENDING'], Literal['SUCCESS']]
 VALID_STATUSES: Final[tuple[State, ...]] = \
     'EXPECTED', 'PENDING', 'FAILURE', 'ERROR', 'SUCCESS'
+# Opening ANSI color codes, left open so that ';7' can be appended.
+COLOR_CODES: Final[Mapping[State, str]] = {
+    'PENDING': '\033[33',   # yellow
+    'EXPECTED': '\033[35',  # magenta
+    'SUCCESS': '\033[32',   # green
+    'FAILURE': '\033[31',   # red
+    'ERROR': '\033[31;1',   # bold red
+}
 
 
-class Check(TypedDict, total=False):
-    '''The result of a single check of a commit.'''
-    state: State
-    context: str
-    createdAt: str
-    repo: str
-    pr: int
-    commit_sha: str
-    ci_name: str
-
-
-def get_check_statuses(client, repo: str, branch: str, checks: list[str],
-                       names_table: Mapping[str, str]) \
-        -> Mapping[str, list[Check]]:
-    '''Yield {check: [status]} for all given checks on PRs in repo.'''
-    owner, is_valid, repo_name = repo.partition('/')
-    if not is_valid:
-        raise ValueError('repository name must contain a slash')
-    statuses: defaultdict[str, list[Check]] = defaultdict(list)
-    response = client.execute(GET_PR_STATUSES_GRAPHQL, {
-        'repoOwner': owner, 'repoName': repo_name, 'baseBranch': branch,
-    })
-    for pull in response['repository']['pullRequests']['nodes']:
-        if pull['isDraft'] or pull['title'].startswith('[WIP]'):
-            continue
-        # We only ever get one commit in the response from GitHub.
-        commit = pull['commits']['nodes'][0]['commit']
-        contexts = ({c['context']: c for c in commit['status']['contexts']}
-                    if commit['status'] else {})
-        for check in checks:
-            # Fallback to 'expected' status with sensible defaults.
-            fallback = {'context': check, 'state': 'EXPECTED',
-                        'createdAt': NOW.strftime(TIMEFORMAT)}
-            statuses[check].append(contexts.get(check, fallback) | {
-                'repo': repo,
-                'pr': pull['number'],
-                'commit_sha': commit['oid'],
-                'ci_name': names_table[check],
-            })
-    return statuses
+def scan_env_dir(path: str, defaults: Mapping[str, str]) \
+        -> tuple[Mapping[str, str], list[os.DirEntry]]:
+    '''List the given directory and apply its DEFAULTS.env, if any.
+
+    Return the given defaults updated from the directory's DEFAULTS.env, and
+    the directory's non-hidden entries.
+    '''
+    with os.scandir(path) as entries:
+        entries = [entry for entry in entries
+                   if not entry.name.startswith('.')]
+    for entry in entries:
+        if entry.name == DEFAULTENV and entry.is_file():
+            defaults = {**defaults, **parse_env_file(entry.path)}
+    return defaults, entries
 
 
 def get_all_checks(defs_dir: str, roles: list[str], containers: list[str],
@@ -114,48 +65,65 @@ def get_all_checks(defs_dir: str, roles: list[str], containers: list[str],
     '''
     name_table: Mapping[str, str] = {}
     all_checks: defaultdict[tuple[str, str], list[str]] = defaultdict(list)
-    for env_path in glob.glob(os.path.join(defs_dir, '*', '*', '*.env')):
-        if env_path.endswith(os.sep + DEFAULTENV):
-            continue
-        check = {}
-        role, docker, env = os.path.relpath(env_path, defs_dir).split(os.sep)
-        if roles and role not in roles:
+    # Walk DIR/ROLE/CONTAINER/*.env, parsing each DEFAULTS.env only once and
+    # passing the accumulated defaults down the tree.
+    root_defaults, role_entries = scan_env_dir(defs_dir, {})
+    for role in role_entries:
+        if not role.is_dir() or (roles and role.name not in roles):
             continue
-        if containers and docker not in containers:
-            continue
-        for envpath in (os.path.join(defs_dir, DEFAULTENV),
-                        os.path.join(defs_dir, role, DEFAULTENV),
-                        os.path.join(defs_dir, role, docker, DEFAULTENV),
-                        os.path.join(defs_dir, role, docker, env)):
-            if os.path.exists(envpath):
-                check.update(parse_env_file(envpath))
-        repo, branch, name = \
-            check['PR_REPO'], check['PR_BRANCH'], check['CHECK_NAME']
-        if repos and repo not in repos:
-            continue
-        if checks and name not in checks:
-            continue
-        name_table[name] = check['CI_NAME']
-        all_checks[(repo, branch)].append(name)
+        role_defaults, docker_entries = scan_env_dir(role.path, root_defaults)
+        for docker in docker_entries:
+            if not docker.is_dir() or \
+               (containers and docker.name not in containers):
+                continue
+            docker_defaults, env_entries = \
+                scan_env_dir(docker.path, role_defaults)
+            for env in env_entries:
+                if env.name == DEFAULTENV or not env.name.endswith('.env') \
+                   or not env.is_file():
+                    continue
+                check = {**docker_defaults, **parse_env_file(env.path)}
+                repo, branch, name = \
+                    check['PR_REPO'], check['PR_BRANCH'], check['CHECK_NAME']
+                if repos and repo not in repos:
+                    continue
+                if checks and name not in checks:
+                    continue
+                name_table[name] = check['CI_NAME']
+                all_checks[(repo, branch)].append(name)
     return all_checks, name_table
 
 
-def output_check_table(pr_statuses: list[Check], recent_days: int) -> None:
+def get_recent_cutoff(recent_days: int) -> str:
+    '''Return the timestamp after which check results count as recent.'''
+    return (NOW - timedelta(days=recent_days)).strftime(TIMEFORMAT)
+
+
+def output_check_table(pr_statuses: list[CheckStatus],
+                       recent_cutoff: str) -> None:
     '''Print a nicely formatted table of PR results for the given check.'''
-    pr_statuses.sort(key=lambda c: c['createdAt'], reverse=True)
-    prnum_len = 1 + math.floor(math.log10(max(c['pr'] for c in pr_statuses)))
+    # Each PR appears once per check, so sorting never compares the statuses.
+    keyed = [(c.createdAt, c.pr, c) for c in pr_statuses]
+    keyed.sort(reverse=True)
+    prnum_len = len(str(max(pr for _, pr, _ in keyed)))
     terminal_width = shutil.get_terminal_size((80, 1)).columns
     items_per_row = ((terminal_width - 2*len(INDENT) + len(SEPARATOR)) //
                      (len('#') + prnum_len + len(SEPARATOR)))
-    for _, row in it.groupby(enumerate(pr_statuses),
-                             key=lambda tpl: tpl[0] // items_per_row):
+    for start in range(0, len(keyed), items_per_row):
         print(format_table_row((
-            (status, f'#{{:{prnum_len}d}}'.format(status['pr']))
-            for _, status in row
-        ), recent_days))
+            (status, f'#{pr:{prnum_len}d}')
+            for _, pr, status in keyed[start:start + items_per_row]
+        ), recent_cutoff))
+
 
+@lru_cache(maxsize=4096)
+def build_log_url(repo: str, pr: int, commit_sha: str, ci_name: str) -> str:
+    '''Return the URL of the document reporting the given check's results.'''
+    return '/'.join(['https://ali-ci.cern.ch/alice-build-logs', repo, str(pr),
+                     commit_sha, ci_name, 'pretty.html'])
 
-def format_status(status: Check, text: str, recent_days: int) -> str:
+
+def format_status(status: CheckStatus, text: str, recent_cutoff: str) -> str:
     '''Color the given text as appropriate for the given status.
 
     If possible, the text is also formatted as a hyperlink to the document
@@ -164,28 +132,14 @@ def format_status(status: Check, text: str, recent_days: int) -> str:
     ansi_escaped = ''
     url: Optional[str] = None
     # If the check is pending or expected, there won't be a result yet.
-    if status['state'] in ('SUCCESS', 'FAILURE', 'ERROR'):
-        try:
-            url = '/'.join([
-                'https://ali-ci.cern.ch/alice-build-logs', status["repo"],
-                str(status["pr"]), status["commit_sha"], status["ci_name"],
-                'pretty.html'
-            ])
-        except KeyError:
-            pass
+    if status.state in ('SUCCESS', 'FAILURE', 'ERROR') and status.commit_sha:
+        url = build_log_url(status.repo, status.pr, status.commit_sha,
+                            status.ci_name)
     if url:
         ansi_escaped += '\033]8;;' + url + '\033\\'  # opening URL code
 
-    ansi_escaped += '\033[' + {   # start opening color code
-        'PENDING': '33',   # yellow
-        'EXPECTED': '35',  # magenta
-        'SUCCESS': '32',   # green
-        'FAILURE': '31',   # red
-        'ERROR': '31;1',   # bold red
-    }[status['state']]
-
-    recent_cutoff = (NOW - timedelta(days=recent_days)).strftime(TIMEFORMAT)
-    if status['createdAt'] > recent_cutoff:
+    ansi_escaped += COLOR_CODES[status.state]  # start opening color code
+    if status.createdAt > recent_cutoff:
         ansi_escaped += ';7'  # reverse video -- swap foreground and background
 
     ansi_escaped += 'm' + text   # finish opening color code and append text
@@ -204,10 +158,10 @@ def format_check_header(check_name: str) -> str:
     return f'{INDENT}\033[4m{check_name}\033[0m'
 
 
-def format_table_row(statuses_and_text: Iterable[tuple[Check, str]],
-                     recent_days: int) -> str:
+def format_table_row(statuses_and_text: Iterable[tuple[CheckStatus, str]],
+                     recent_cutoff: str) -> str:
     '''Format each text for its accompanying status and optional URL.'''
-    return 2*INDENT + SEPARATOR.join(format_status(status, text, recent_days)
+    return 2*INDENT + SEPARATOR.join(format_status(status, text, recent_cutoff)
                                      for status, text in statuses_and_text)
 
 
@@ -218,21 +172,22 @@ def format_empty_table():
 
 def main(args: argparse.Namespace) -> None:
     '''Main entry point.'''
-    client = Client(
-        transport=AIOHTTPTransport(
-            url='https://api.github.com/graphql',
-            headers={'Authorization': 'bearer ' + os.environ['GITHUB_TOKEN']}),
-        fetch_schema_from_transport=True)
     all_checks, names = \
         get_all_checks(args.definitions_dir, args.roles,
                        args.containers, args.repos, args.checks)
+    client = make_client()
+    try:
+        all_statuses = get_all_check_statuses(client, all_checks, names)
+    finally:
+        client.close()
+    recent_cutoff = get_recent_cutoff(args.recent_days)
     for (repo, branch), checks in sorted(all_checks.items()):
         print(format_repo_header(repo, branch))
-        statuses = get_check_statuses(client, repo, branch, checks, names)
+        statuses = all_statuses[repo, branch]
         for check in sorted(checks):
             print(format_check_header(check))
             if statuses[check]:
-                output_check_table(statuses[check], args.recent_days)
+                output_check_table(statuses[check], recent_cutoff)
             else:
                 print(format_empty_table())
             print()
@@ -259,16 +214,17 @@ def parse_args() -> argparse.Namespace:
             repo_header=format_repo_header('owner/repository', 'base branch'),
             check_header=format_check_header('check name'),
             recent_table_row=format_table_row((
-                ({'state': status, 'createdAt': NOW.strftime(TIMEFORMAT)},
+                (CheckStatus(state=status,
+                             createdAt=NOW.strftime(TIMEFORMAT)),
                  status.lower() + ' (recent)')
                 for status in VALID_STATUSES
-            ), 2),
+            ), get_recent_cutoff(2)),
             old_table_row=format_table_row((
-                ({'state': status,
-                  'createdAt': (NOW - timedelta(days=1)).strftime(TIMEFORMAT)},
+                (CheckStatus(state=status, createdAt=(
+                    NOW - timedelta(days=1)).strftime(TIMEFORMAT)),
                  status.lower() + ' (older) ')
                 for status in VALID_STATUSES
-            ), 0)))
+            ), get_recent_cutoff(0))))
 
     parser.add_argument(
         '--definitions-dir', metavar='DIR', default='ali-bot/ci/repo-config',
@@ -1,37 +1,43 @@
 """Fetch information about pull requests and their check states."""
 
+import sys
 from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Literal, TypedDict
+from functools import lru_cache
+from typing import Literal
 
 from gql import gql
+from gql.transport.exceptions import (
+    TransportQueryError, TransportServerError,
+)
 from graphql.language.ast import DocumentNode
 
+from ci_overview.checks import TIMEFORMAT
+
 State = Literal['EXPECTED'] | Literal['ERROR'] | Literal['FAILURE'] | \
     Literal['PENDING'] | Literal['SUCCESS']
 VALID_STATUSES: tuple[State, ...] = \
     'EXPECTED', 'PENDING', 'FAILURE', 'ERROR', 'SUCCESS'
 
-NOW: datetime = datetime.utcnow()
-GET_PR_STATUSES_GRAPHQL: DocumentNode = gql('''\
-query statuses($repoOwner: String!, $repoName: String!, $baseBranch: String!) {
-  repository(owner: $repoOwner, name: $repoName) {
-    pullRequests(last: 50, baseRefName: $baseBranch, states: OPEN) {
+PULL_REQUEST_STATUSES_FRAGMENT: str = '''\
+fragment pullRequestStatuses on PullRequestConnection {
+  nodes {
+    number
+    title
+    isDraft
+    commits(last: 1) {
       nodes {
-        number
-        title
-        isDraft
-        commits(last: 1) {
-          nodes {
-            commit {
-              oid
-              status {
-                contexts {
-                  context
-                  state
-                  createdAt
-                }
-              }
+        commit {
+          oid
+          status {
+            contexts {
+              context
+              state
+              createdAt
+              targetUrl
             }
           }
         }
@@ -39,42 +45,92 @@ query statuses($repoOwner: String!, $repoName: String!, $baseBranch: String!) {
     }
   }
 }
-''')
+'''
+GET_PR_STATUSES_GRAPHQL: DocumentNode = gql('''\
+query statuses($repoOwner: String!, $repoName: String!, $baseBranch: String!) {
+  repository(owner: $repoOwner, name: $repoName) {
+    pullRequests(last: 50, baseRefName: $baseBranch, states: OPEN) {
+      ...pullRequestStatuses
+    }
+  }
+}
+
+''' + PULL_REQUEST_STATUSES_FRAGMENT)
+# GitHub refuses queries that could return more than 500,000 nodes. Each
+# repository costs 50 pull requests plus one commit for each of them.
+MAX_QUERY_NODES: int = 400_000
+NODES_PER_REPO: int = 50 + 50 * 1
+# Too many parallel requests trip GitHub's secondary rate limits.
+MAX_PARALLEL_QUERIES: int = 8
 
 
-class CheckStatus(TypedDict, total=False):
+@dataclass(slots=True)
+class CheckStatus:
     '''The result of a single check of a commit.'''
     state: State
-    context: str
     createdAt: str
-    repo: str
-    pr: int
-    commit_sha: str
-    ci_name: str
+    context: str = ''
+    repo: str | None = None
+    pr: int | None = None
+    commit_sha: str | None = None
+    ci_name: str | None = None
+    targetUrl: str | None = None
+
+
+@lru_cache(maxsize=4096)
+def status_url(repo: str | None, pr: int | None,
+               target_url: str | None) -> str | None:
+    '''Construct a useful URL for a check, falling back to its PR.'''
+    if target_url:
+        return target_url
+    if repo is None or pr is None:
+        return None
+    return f'https://github.com/{repo}/pull/{pr}'
 
 
 def get_status_url(status: CheckStatus) -> str | None:
     '''Construct a useful URL for the given check, falling back to its PR.'''
-    if (url := status.get('targetUrl')):
-        return url
-    try:
-        return 'https://github.com/{repo}/pull/{pr}'.format(**status)
-    except KeyError:
-        return None
+    return status_url(status.repo, status.pr, status.targetUrl)
 
 
-def get_check_statuses(client, repo: str, branch: str, checks: list[str],
-                       names_table: dict[str, str]) \
-        -> dict[str, list[CheckStatus]]:
-    '''Yield {check: [status]} for all given checks on PRs in repo.'''
+def split_repo(repo: str) -> tuple[str, str]:
+    '''Split an ORG/REPO string into its owner and name.'''
     owner, is_valid, repo_name = repo.partition('/')
     if not is_valid:
         raise ValueError('repository name must contain a slash')
+    return owner, repo_name
+
+
+@lru_cache
+def batched_statuses_query(num_repos: int) -> DocumentNode:
+    '''Build a query fetching PR statuses for num_repos repos at once.
+
+    Each repository is aliased as repoN and takes its owner, name and base
+    branch from the $ownerN, $nameN and $branchN variables, so the document
+    only depends on the number of repositories and can be reused.
+    '''
+    params = ', '.join(f'$owner{i}: String!, $name{i}: String!, '
+                       f'$branch{i}: String!' for i in range(num_repos))
+    aliases = ''.join(f'''\
+  repo{i}: repository(owner: $owner{i}, name: $name{i}) {{
+    pullRequests(last: 50, baseRefName: $branch{i}, states: OPEN) {{
+      ...pullRequestStatuses
+    }}
+  }}
+''' for i in range(num_repos))
+    return gql(f'query statuses({params}) {{\n{aliases}}}\n\n'
+               + PULL_REQUEST_STATUSES_FRAGMENT)
+
+
+def parse_pull_requests(repo: str, pull_requests: dict, checks: list[str],
+                        names_table: Mapping[str, str], now: str) \
+        -> dict[str, list[CheckStatus]]:
+    '''Return {check: [status]} given a repo's pullRequests response.
+
+    Checks that haven't reported a status yet are "expected" as of now.
+    '''
     statuses: defaultdict[str, list[CheckStatus]] = defaultdict(list)
-    response = client.execute(GET_PR_STATUSES_GRAPHQL, {
-        'repoOwner': owner, 'repoName': repo_name, 'baseBranch': branch,
-    })
-    for pull in response['repository']['pullRequests']['nodes']:
+    for pull in pull_requests['nodes']:
         if pull['isDraft'] or pull['title'].startswith('[WIP]'):
             continue
         # We only ever get one commit in the response from GitHub.
@@ -82,13 +138,89 @@ def get_check_statuses(client, repo: str, branch: str, checks: list[str],
         contexts = ({c['context']: c for c in commit['status']['contexts']}
                     if commit['status'] else {})
         for check in checks:
-            # Fallback to 'expected' status with sensible defaults.
-            fallback = {'context': check, 'state': 'EXPECTED',
-                        'createdAt': NOW.strftime(TIMEFORMAT)}
-            statuses[check].append(contexts.get(check, fallback) | {
-                'repo': repo,
-                'pr': pull['number'],
-                'commit_sha': commit['oid'],
-                'ci_name': names_table[check],
-            })
+            if (context := contexts.get(check)):
+                state = context['state']
+                created_at = context['createdAt']
+                target_url = context['targetUrl']
+            else:
+                # Fallback to 'expected' status with sensible defaults.
+                state = 'EXPECTED'
+                created_at = now
+                target_url = None
+            statuses[check].append(CheckStatus(
+                state=state, createdAt=created_at, context=check, repo=repo,
+                pr=pull['number'], commit_sha=commit['oid'],
+                ci_name=names_table[check], targetUrl=target_url,
+            ))
     return statuses
+
+
+def get_check_statuses(client, repo: str, branch: str, checks: list[str],
+                       names_table: Mapping[str, str], now: str) \
+        -> dict[str, list[CheckStatus]]:
+    '''Return {check: [status]} for all given checks on PRs in repo.'''
+    owner, repo_name = split_repo(repo)
+    response = client.execute(GET_PR_STATUSES_GRAPHQL, {
+        'repoOwner': owner, 'repoName': repo_name, 'baseBranch': branch,
+    })
+    return parse_pull_requests(repo, response['repository']['pullRequests'],
+                               checks, names_table, now)
+
+
+def get_check_statuses_separately(
+        client, items: list[tuple[tuple[str, str], list[str]]],
+        names_table: Mapping[str, str], now: str,
+) -> dict[tuple[str, str], dict[str, list[CheckStatus]]]:
+    '''Query each given repository in parallel, skipping broken ones.'''
+    def fetch(item: tuple[tuple[str, str], list[str]]) \
+            -> dict[str, list[CheckStatus]]:
+        (repo, branch), checks = item
+        try:
+            return get_check_statuses(client, repo, branch, checks,
+                                      names_table, now)
+        except (TransportQueryError, TransportServerError) as exc:
+            print(f'Could not fetch statuses for {repo} ({branch}):', exc,
+                  file=sys.stderr)
+            return defaultdict(list)
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_QUERIES) as executor:
+        return dict(zip((key for key, _ in items), executor.map(fetch, items)))
+
+
+def get_all_check_statuses(client,
+                           all_checks: Mapping[tuple[str, str], list[str]],
+                           names_table: Mapping[str, str],
+                           now: str | None = None) \
+        -> dict[tuple[str, str], dict[str, list[CheckStatus]]]:
+    '''Return {(repo, branch): {check: [status]}} for all given checks.
+
+    now is the timestamp given to checks that haven't reported a status yet;
+    it defaults to the current time.
+
+    Repositories are queried in as few requests as GitHub's node limit allows.
+    If a batched query fails, each of its repositories is queried separately
+    (in parallel), so that one broken repository doesn't hide the results for
+    the others.
+    '''
+    if now is None:
+        now = datetime.utcnow().strftime(TIMEFORMAT)
+    items = sorted(all_checks.items())
+    batch_size = MAX_QUERY_NODES // NODES_PER_REPO
+    all_statuses: dict[tuple[str, str], dict[str, list[CheckStatus]]] = {}
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        variables = {}
+        for i, ((repo, branch), _) in enumerate(batch):
+            variables[f'owner{i}'], variables[f'name{i}'] = split_repo(repo)
+            variables[f'branch{i}'] = branch
+        try:
+            response = client.execute(batched_statuses_query(len(batch)),
+                                      variables)
+        except (TransportQueryError, TransportServerError):
+            all_statuses.update(get_check_statuses_separately(
+                client, batch, names_table, now))
+            continue
+        for i, ((repo, branch), checks) in enumerate(batch):
+            all_statuses[repo, branch] = parse_pull_requests(
+                repo, response[f'repo{i}']['pullRequests'],
+                checks, names_table, now)
+    return all_statuses
@@ -1,11 +1,71 @@
 """Show an overview of the CI system in the user's terminal."""
 
 from __future__ import annotations
-import itertools as it
+import os
+import sys
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from functools import lru_cache
+from operator import attrgetter
 from shutil import get_terminal_size
-from collections.abc import Iterable   # for type checking
+from collections.abc import Mapping   # for type checking
+from typing import TextIO
 
-from ci_overview.pull_requests import CheckStatus
+from ci_overview.api_client import make_client
+from ci_overview.checks import TIMEFORMAT, checks_by_repo, get_all_checks
+from ci_overview.pull_requests import (
+    CheckStatus, State, get_all_check_statuses, get_status_url,
+)
+
+
+# Mark statuses newer than this as recent.
+RECENT_HOURS: float = 24
+# Opening ANSI color codes, left open so that ';7' can be appended.
+_COLOR: dict[State, str] = {
+    'PENDING': '\033[33',    # yellow
+    'EXPECTED': '\033[90',   # gray (bright black)
+    'SUCCESS': '\033[32',    # green
+    'ERROR': '\033[31',      # red
+    'FAILURE': '\033[31;1',  # bold red
+}
+# Complete opening ANSI codes for each state and whether it's recent. Recent
+# statuses are shown in reverse video (swapping fore- and background).
+_PREFIX: dict[tuple[State, bool], str] = {
+    (state, recent): color + (';7m' if recent else 'm')
+    for state, color in _COLOR.items() for recent in (True, False)
+}
+# Without colors, mark each PR number's state with a character after it, and
+# mark recent statuses with an asterisk.
+_PLAIN_MARKER: dict[State, str] = {
+    'PENDING': '~',
+    'EXPECTED': '?',
+    'SUCCESS': '+',
+    'ERROR': '-',
+    'FAILURE': '!',
+}
+_PLAIN_SUFFIX: dict[tuple[State, bool], str] = {
+    (state, recent): marker + ('*' if recent else ' ')
+    for state, marker in _PLAIN_MARKER.items() for recent in (True, False)
+}
+
+
+@lru_cache(maxsize=4096)
+def _format_cell(prefix: str, url: str | None, text: str) -> str:
+    '''Color text using the given opening ANSI code, and link it to url.
+
+    The same PR often has the same state for many checks, so cells repeat.
+    '''
+    if url:
+        # Wrap the text in opening and closing URL codes.
+        return f'\033]8;;{url}\033\\{prefix}{text}\033]8;;\033\\\033[0m'
+    return f'{prefix}{text}\033[0m'
+
+
+def _format_plain_cell(suffix: str, url: str | None, text: str) -> str:
+    '''Append the given state marker to text, and link it to url.'''
+    if url:
+        return f'\033]8;;{url}\033\\{text}{suffix}\033]8;;\033\\'
+    return text + suffix
 
 
 class Output:
@@ -13,69 +73,186 @@ class Output:
 
 
 class TextOutput(Output):
-    '''Show the overview on the terminal in nice colours.'''
+    '''Show the overview on the terminal in nice colours.
+
+    Output is collected in memory; call flush() to write it out.
+    '''
     INDENT: str = '  '
     SEPARATOR: str = '  '
+    _ROW_INDENT: str = 2 * INDENT
+    # Lengths used to work out how many PRs fit on a row.
+    _INDENT_LEN: int = len(INDENT)
+    _SEPARATOR_LEN: int = len(SEPARATOR)
+    _HASH_LEN: int = len('#')
+    _EMPTY_TABLE: str = \
+        _ROW_INDENT + '\033[3;90m(no open non-draft PRs here)\033[0m\n\n'
+    # How to format each cell, and the code passed to it for each status.
+    _CELL_CODES: dict[tuple[State, bool], str] = _PREFIX
+    _format_cell = staticmethod(_format_cell)
+
+    def __init__(self: TextOutput, output_file: TextIO,
+                 recent_cutoff: str) -> None:
+        self.output_file = output_file
+        self.recent_cutoff = recent_cutoff
+        # The output is generated in one go, so don't query this every time.
+        self._term_width = get_terminal_size((80, 1)).columns
+        # Hyperlinks are only useful if a terminal is going to display them.
+        self._emit_links = getattr(output_file, 'isatty', lambda: False)()
+        # Output is collected here and written out in one go by flush().
+        self._buf: list[str] = []
+
+    def flush(self: TextOutput) -> None:
+        '''Write out everything output so far.'''
+        text = ''.join(self._buf)
+        self._buf.clear()
+        output_file = self.output_file
+        try:
+            buffer = output_file.buffer
+        except AttributeError:  # not backed by a binary file, e.g. StringIO
+            output_file.write(text)
+            output_file.flush()
+            return
+        # Encode everything in one go and skip the text layer, flushing it
+        # first in case anything else was written to it.
+        output_file.flush()
+        buffer.write(text.encode(output_file.encoding or 'utf-8',
+                                 output_file.errors or 'strict'))
+        buffer.flush()
 
     def repo_header(self: TextOutput, repo: str, branch: str) -> None:
         '''Format repo bold and underlined, and italicize branch.'''
-        print(f'\033[4;1m{repo}\033[0m  \033[3m({branch})\033[0m',
-              file=self.output_file)
+        self._buf.append(
+            f'\033[4;1m{repo}\033[0m  \033[3m({branch})\033[0m\n')
 
     def check_header(self: TextOutput, check_name: str) -> None:
         '''Format the given check name by underlining.'''
-        print(f'{self.INDENT}\033[4m{check_name}\033[0m',
-              file=self.output_file)
+        self._buf.append(f'{self.INDENT}\033[4m{check_name}\033[0m\n')
 
     def empty_table(self: TextOutput) -> None:
         '''Create a helpful message for a table with no PRs.'''
-        print(self.INDENT, self.INDENT,
-              '\033[3;90m(no open non-draft PRs here)\033[0m',
-              sep='', end='\n\n', file=self.output_file)
-
-    def overview_table(self: TextOutput, pr_statuses: list[CheckStatus]) -> None:
-        '''Print a nicely formatted table of PR results for the given check.'''
-        prnum_len, template = self.overview_table_prep(pr_statuses)
-        terminal_width = get_terminal_size((80, 1)).columns
-        items_per_row = ((terminal_width - 2*len(self.INDENT) + len(self.SEPARATOR)) //
-                         (len('#') + prnum_len + len(self.SEPARATOR)))
-        for _, row in it.groupby(enumerate(pr_statuses),
-                                 key=lambda tpl: tpl[0] // items_per_row):
-            self.table_row(((status, template.format(status['pr']))
-                            for _, status in row))
-        print(file=self.output_file)
-
-    def table_row(self: TextOutput,
-                  statuses_and_text: Iterable[tuple[CheckStatus, str]]) -> None:
-        '''Format each text for its accompanying status and optional URL.'''
-        print(self.INDENT, self.INDENT, sep='', end='', file=self.output_file)
-        print(*(self.format_status(status, text)
-                for status, text in statuses_and_text),
-              sep=self.SEPARATOR, file=self.output_file)
-
-    def format_status(self: TextOutput, status: CheckStatus, text: str) -> str:
-        '''Color the given text as appropriate for the given status.
-
-        If possible, the text is also formatted as a hyperlink to the document
-        reporting check results.
+        self._buf.append(self._EMPTY_TABLE)
+
+    def prepare_repo(self: TextOutput,
+                     statuses: Mapping[str, list[CheckStatus]]) \
+            -> tuple[dict[int, str], int]:
+        '''Work out the table layout shared by all checks in a repository.
+
+        statuses maps check names to their statuses. Return the text to show
+        for each PR and the number of PRs per table row.
+        '''
+        prs = {status.pr for check_statuses in statuses.values()
+               for status in check_statuses}
+        prnum_len = len(str(max(prs, default=0)))
+        pr_texts = {pr: '#' + str(pr).rjust(prnum_len) for pr in prs}
+        items_per_row = \
+            ((self._term_width - 2*self._INDENT_LEN + self._SEPARATOR_LEN) //
+             (self._HASH_LEN + prnum_len + self._SEPARATOR_LEN))
+        return pr_texts, items_per_row
+
+    def overview_table_prep(self: TextOutput, pr_statuses: list[CheckStatus]) \
+            -> tuple[list[str | None], list[str]]:
+        '''Sort statuses most recent first and precompute their formatting.
+
+        Return each status's URL (if any) and opening ANSI code, in the
+        sorted order.
         '''
-        ansi_escaped = ''
-        url = get_status_url(status)
-        if url:
-            ansi_escaped += '\033]8;;' + url + '\033\\'  # opening URL code
-
-        ansi_escaped += '\033[' + {   # start opening color code
-            'PENDING': '33',    # yellow
-            'EXPECTED': '90',   # gray (bright black)
-            'SUCCESS': '32',    # green
-            'ERROR': '31',      # red
-            'FAILURE': '31;1',  # bold red
-        }[status['state']]
-
-        if status['createdAt'] > self.recent_cutoff:
-            ansi_escaped += ';7'  # reverse video -- swap fore- and background
-
-        ansi_escaped += 'm' + text   # finish color code and append text
-        if url:
-            ansi_escaped += '\033]8;;\033\\'  # closing URL code
-        return ansi_escaped + '\033[0m'  # closing color code
+        pr_statuses.sort(key=attrgetter('createdAt'), reverse=True)
+        recent_cutoff, cell_codes = self.recent_cutoff, self._CELL_CODES
+        if self._emit_links:
+            urls = [get_status_url(status) for status in pr_statuses]
+        else:
+            urls = [None] * len(pr_statuses)
+        # Statuses are sorted newest first, so the recent ones come first.
+        num_recent = bisect_left(pr_statuses, True, key=lambda status:
+                                 status.createdAt <= recent_cutoff)
+        prefixes = [cell_codes[status.state, True]
+                    for status in pr_statuses[:num_recent]]
+        prefixes += [cell_codes[status.state, False]
+                     for status in pr_statuses[num_recent:]]
+        return urls, prefixes
+
+    def overview_table(self: TextOutput, pr_statuses: list[CheckStatus],
+                       layout: tuple[dict[int, str], int] | None = None) \
+            -> None:
+        '''Print a nicely formatted table of PR results for the given check.
+
+        layout is the result of prepare_repo for the check's repository. If
+        it isn't given, it's worked out from pr_statuses alone.
+        '''
+        if layout is None:
+            layout = self.prepare_repo({'': pr_statuses})
+        pr_texts, items_per_row = layout
+        urls, prefixes = self.overview_table_prep(pr_statuses)
+        # Look up methods and attributes once, not again for every row.
+        append, join = self._buf.append, self.SEPARATOR.join
+        row_indent, format_cell = self._ROW_INDENT, self._format_cell
+        for start in range(0, len(pr_statuses), items_per_row):
+            stop = start + items_per_row
+            texts = [pr_texts[status.pr]
+                     for status in pr_statuses[start:stop]]
+            cells = join(map(format_cell, prefixes[start:stop],
+                             urls[start:stop], texts))
+            append(f'{row_indent}{cells}\n')
+        append('\n')
+
+
+class PlainTextOutput(TextOutput):
+    '''Show the overview on the terminal without any colours or styles.
+
+    Each PR number is followed by a character showing its state, and an
+    asterisk if it is recent. Hyperlinks are still emitted for terminals.
+    '''
+    # Each PR number has a state and recency marker after it too.
+    _HASH_LEN: int = len('#') + 2
+    _EMPTY_TABLE: str = \
+        TextOutput._ROW_INDENT + '(no open non-draft PRs here)\n\n'
+    _CELL_CODES: dict[tuple[State, bool], str] = _PLAIN_SUFFIX
+    _format_cell = staticmethod(_format_plain_cell)
+
+    def repo_header(self: PlainTextOutput, repo: str, branch: str) -> None:
+        '''Show the repo and branch names.'''
+        self._buf.append(f'{repo}  ({branch})\n')
+
+    def check_header(self: PlainTextOutput, check_name: str) -> None:
+        '''Show the given check name.'''
+        self._buf.append(f'{self.INDENT}{check_name}\n')
+
+
+def make_text_output(output_file: TextIO, recent_cutoff: str) -> TextOutput:
+    '''Return a TextOutput, or a PlainTextOutput if colours are unwanted.
+
+    Colours are left out if output_file isn't a terminal, or if NO_COLOR is
+    set (see https://no-color.org/).
+    '''
+    if os.environ.get('NO_COLOR') or \
+       not getattr(output_file, 'isatty', lambda: False)():
+        return PlainTextOutput(output_file, recent_cutoff)
+    return TextOutput(output_file, recent_cutoff)
+
+
+def main() -> None:
+    '''Fetch all checks and their statuses, and show them on stdout.'''
+    client = make_client()
+    try:
+        all_checks, names_table = checks_by_repo(get_all_checks(client))
+        all_statuses = get_all_check_statuses(client, all_checks, names_table)
+    finally:
+        client.close()
+    recent_cutoff = (datetime.utcnow() - timedelta(hours=RECENT_HOURS)) \
+        .strftime(TIMEFORMAT)
+    output = make_text_output(sys.stdout, recent_cutoff)
+    for (repo, branch), checks in sorted(all_checks.items()):
+        output.repo_header(repo, branch)
+        statuses = all_statuses[repo, branch]
+        layout = output.prepare_repo(statuses)
+        for check in sorted(checks):
+            output.check_header(check)
+            if statuses[check]:
+                output.overview_table(statuses[check], layout)
+            else:
+                output.empty_table()
+    output.flush()
+
+
+if __name__ == '__main__':
+    main()